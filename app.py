@@ -1,28 +1,435 @@
+import atexit
+import hashlib
+import multiprocessing
 import os
+import queue
+import signal
+import stat
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify
-from git import Repo, InvalidGitRepositoryError
+from flask import Flask, Response, render_template, request, jsonify, send_file
+from git import Actor, Commit, Repo, InvalidGitRepositoryError, SymbolicReference
 
 app = Flask(__name__)
+# fsync saved notes before they replace the old file. Off by default: autosave
+# runs every couple of seconds and the previous version is still in git.
+app.config.setdefault("FSYNC_ON_SAVE", False)
+
+# Repo handles are kept for the lifetime of the app so every save reuses the
+# same object database (and its long-running `git cat-file` helpers) instead
+# of re-opening the repository each time.
+_repos = {}
 
 
 def get_or_init_repo(directory):
-    try:
-        repo = Repo(directory)
-    except InvalidGitRepositoryError:
-        repo = Repo.init(directory)
+    repo = _repos.get(directory)
+    if repo is None:
+        try:
+            repo = Repo(directory)
+        except InvalidGitRepositoryError:
+            repo = Repo.init(directory)
+        # Only GitPython's own cat-file helpers run git here; they never need
+        # the optional index lock or a credentials prompt.
+        repo.git.update_environment(GIT_OPTIONAL_LOCKS="0", GIT_TERMINAL_PROMPT="0")
+        repo = _repos.setdefault(directory, repo)
     return repo
 
 
+# Author and committer are read from the git config once per repository
+# instead of re-parsing the config files for every commit.
+_actors = {}
+
+
+def get_actors(repo):
+    actors = _actors.get(repo.git_dir)
+    if actors is None:
+        reader = repo.config_reader()
+        actors = _actors[repo.git_dir] = (Actor.author(reader), Actor.committer(reader))
+    return actors
+
+
+# Parsed indexes are kept between batches as well; one is only re-read when
+# .git/index was replaced or modified since we last wrote it (e.g. by a `git`
+# command run by hand in that repository).
+_indexes = {}
+
+
+def stat_signature(st):
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def file_signature(path):
+    try:
+        return stat_signature(os.stat(path))
+    except FileNotFoundError:
+        return None
+
+
+def get_index(repo):
+    cached = _indexes.get(repo.git_dir)
+    if cached is not None:
+        index, signature = cached
+        if signature is not None and signature == file_signature(index.path):
+            return index
+    return repo.index
+
+
+# HEAD is resolved from the ref files and the tree of the last commit we made
+# is remembered, so the no-op check doesn't have to fetch the commit object
+# through git's cat-file pipe on every batch.
+_head_trees = {}
+
+
+def head_commit(repo):
+    try:
+        hexsha = SymbolicReference.dereference_recursive(repo, "HEAD")
+    except ValueError:
+        return None
+    return Commit(repo, bytes.fromhex(hexsha))
+
+
+def head_tree(repo, head):
+    cached = _head_trees.get(repo.git_dir)
+    if cached is not None and cached[0] == head.binsha:
+        return cached[1]
+    return head.tree.binsha
+
+
+# Autosaves are written to disk straight away but committed in batches: each
+# save pushes the commit back by COMMIT_DELAY seconds, and a file that keeps
+# changing is flushed at most COMMIT_MAX_DELAY seconds after its first edit.
+COMMIT_DELAY = 10
+COMMIT_MAX_DELAY = 30
+
+_pending = {}
+_pending_lock = threading.Lock()
+
+# All git work happens on a single worker thread fed through this queue, which
+# keeps it off the request path and serialises access to the cached repos.
+commit_q = queue.Queue()
+
+
+def commit_files(dirname, filenames, message):
+    repo = get_or_init_repo(dirname)
+    print("Git repository ready")
+
+    index = get_index(repo)
+    head = head_commit(repo)
+    # If this is the index we left in step with HEAD last time and HEAD hasn't
+    # moved, comparing the blob ids of the re-added files tells us whether
+    # anything changed without building the tree.
+    in_sync = (
+        _indexes.get(repo.git_dir, (None,))[0] is index
+        and head is not None
+        and _head_trees.get(repo.git_dir, (None,))[0] == head.binsha
+    )
+    before = [index.entries.get((name, 0)) for name in filenames]
+
+    # The caches are only updated once the batch has fully gone through; if
+    # anything fails (say a stale ref lock), they are dropped so the next
+    # batch re-reads the index and re-checks the tree instead of trusting
+    # an index that is ahead of HEAD.
+    try:
+        index.add(filenames)
+        signature = file_signature(index.path)
+        print(f"Added {', '.join(filenames)} to staging")
+
+        after = [index.entries.get((name, 0)) for name in filenames]
+        if in_sync and all(
+            old is not None and old.binsha == new.binsha
+            for old, new in zip(before, after)
+        ):
+            _indexes[repo.git_dir] = (index, signature)
+            print("Nothing to commit")
+            return
+
+        # Compare trees instead of committing blindly so identical saves
+        # don't pile up empty commits.
+        tree = index.write_tree()
+        if head is not None and head_tree(repo, head) == tree.binsha:
+            committed = head.binsha
+            print("Nothing to commit")
+        else:
+            author, committer = get_actors(repo)
+            # Commit the tree we already built rather than going through
+            # index.commit, which would write it again. This also skips commit
+            # hooks, the same as `git commit --no-verify`.
+            committed = Commit.create_from_tree(
+                repo,
+                tree,
+                message,
+                parent_commits=[head] if head else [],
+                head=True,
+                author=author,
+                committer=committer,
+            ).binsha
+            print("Commit created")
+    except Exception:
+        _indexes.pop(repo.git_dir, None)
+        _head_trees.pop(repo.git_dir, None)
+        raise
+
+    _indexes[repo.git_dir] = (index, signature)
+    _head_trees[repo.git_dir] = (committed, tree.binsha)
+
+
+# Files that share a repository go into a single commit, so each repo reads
+# and writes its index once per batch.
+def group_by_repo(items):
+    by_repo = {}
+    for abs_path, message in dict(items).items():
+        dirname, filename = os.path.split(abs_path)
+        by_repo.setdefault(dirname, {})[filename] = message
+    return by_repo
+
+
+def commit_batch(by_repo):
+    for dirname, messages in by_repo.items():
+        if len(messages) == 1:
+            message = next(iter(messages.values()))
+        else:
+            message = f"Update {len(messages)} files\n\n" + "\n".join(
+                messages.values()
+            )
+        try:
+            commit_files(dirname, list(messages), message)
+        except Exception as e:
+            print(f"Commit failed in {dirname}: {e}")
+
+
+# The git work itself (hashing, zlib, index and tree serialisation) runs in a
+# single child process, so it doesn't compete with request handling for the
+# GIL. The repo/index caches above live in that process.
+_executor = None
+
+
+def _init_commit_process():
+    # Ctrl+C is for the server; the child finishes its batch and exits with
+    # the pool instead of dying mid-commit with a traceback of its own.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _commit_worker():
+    global _executor
+    while True:
+        batch = [commit_q.get()]
+        # Drain whatever queued up while the last batch was committing; if a
+        # path shows up more than once only its latest message is kept.
+        while True:
+            try:
+                batch.append(commit_q.get_nowait())
+            except queue.Empty:
+                break
+
+        by_repo = group_by_repo(batch)
+        try:
+            try:
+                if _executor is None:
+                    _executor = ProcessPoolExecutor(
+                        max_workers=1,
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_init_commit_process,
+                    )
+                _executor.submit(commit_batch, by_repo).result()
+            except RuntimeError:
+                # The pool broke or the interpreter is shutting down (the
+                # exit-time flush lands here); commit in this process instead.
+                if _executor is not None:
+                    _executor.shutdown(wait=False)
+                _executor = None
+                commit_batch(by_repo)
+        except Exception as e:
+            # A failed batch must not take the worker down with it, or every
+            # later commit would sit in the queue forever.
+            print(f"Commit batch failed: {e}")
+        finally:
+            for _ in batch:
+                commit_q.task_done()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def queue_commit(abs_path, message):
+    global _worker
+    # Started on first use rather than at import, so the debug reloader's
+    # watcher process never spins up a worker of its own.
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_commit_worker, daemon=True)
+            _worker.start()
+    commit_q.put((abs_path, message))
+
+
+def schedule_commit(abs_path):
+    now = datetime.now()
+    with _pending_lock:
+        pending = _pending.get(abs_path)
+        if pending is None:
+            pending = _pending[abs_path] = {"first": now, "writes": 0}
+        else:
+            pending["timer"].cancel()
+        pending["writes"] += 1
+        pending["last"] = now
+
+        elapsed = (now - pending["first"]).total_seconds()
+        delay = max(0, min(COMMIT_DELAY, COMMIT_MAX_DELAY - elapsed))
+        timer = threading.Timer(delay, commit_pending, args=(abs_path,))
+        timer.daemon = True
+        pending["timer"] = timer
+        timer.start()
+
+
+def pending_message(abs_path):
+    with _pending_lock:
+        pending = _pending.pop(abs_path, None)
+    if pending is None:
+        return None
+
+    filename = os.path.basename(abs_path)
+    first, last = pending["first"], pending["last"]
+    writes = pending["writes"]
+    message = (
+        f"Update {filename} - {last:%Y-%m-%d %H:%M:%S} "
+        f"({writes} edit{'' if writes == 1 else 's'} since {first:%H:%M:%S})"
+    )
+    return message
+
+
+def commit_pending(abs_path):
+    message = pending_message(abs_path)
+    if message is not None:
+        queue_commit(abs_path, message)
+
+
+@atexit.register
+def flush_pending_commits():
+    with _pending_lock:
+        paths = list(_pending)
+        for path in paths:
+            _pending[path]["timer"].cancel()
+
+    with _worker_lock:
+        worker = _worker
+    if worker is None:
+        # Nothing has been queued yet, and new threads can't be started while
+        # the interpreter shuts down, so commit the leftovers right here.
+        items = []
+        for path in paths:
+            message = pending_message(path)
+            if message is not None:
+                items.append((path, message))
+        commit_batch(group_by_repo(items))
+        return
+
+    for path in paths:
+        commit_pending(path)
+    commit_q.join()
+
+
+# Digest of the last content written to each file, along with the signature
+# of the file that write produced. While the signature still matches, the
+# digest describes what's on disk: a save that doesn't change anything never
+# touches the disk or git, and the digest doubles as the file's ETag.
+_digests = {}
+
+
+def known_digest(abs_path):
+    saved = _digests.get(abs_path)
+    if saved is not None and saved[1] == file_signature(abs_path):
+        return saved[0]
+    return None
+
+
+def content_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def copy_ownership(fd, tmp_path, st):
+    mode = stat.S_IMODE(st.st_mode)
+    if hasattr(os, "fchmod"):
+        os.fchmod(fd, mode)
+    else:
+        os.chmod(tmp_path, mode)
+    if hasattr(os, "fchown") and (st.st_uid, st.st_gid) != (os.getuid(), os.getgid()):
+        try:
+            os.fchown(fd, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass
+
+
+# Notes are written to a temp file in one go and moved over the original with
+# os.replace, so a crash mid-save never leaves a truncated note behind. Each
+# save gets its own temp file, so overlapping saves of one note (two tabs)
+# can't clobber each other's. Symlinks are followed so the link survives and
+# its target is what gets updated, and an existing note's mode (and, where
+# permitted, owner) is copied onto the temp file; a new note is created like
+# open() would (0o666 less the umask). Hardlinks to a note are not preserved.
+def write_file(abs_path, data):
+    if os.linesep != "\n":
+        data = data.replace(b"\n", os.linesep.encode())
+
+    real_path = os.path.realpath(abs_path)
+    try:
+        existing = os.stat(real_path)
+    except FileNotFoundError:
+        existing = None
+
+    tmp_path = f"{real_path}.{uuid.uuid4().hex}.tmp"
+    fd = os.open(
+        tmp_path,
+        os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0),
+        0o666,
+    )
+    try:
+        try:
+            if existing is not None:
+                copy_ownership(fd, tmp_path, existing)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            if app.config["FSYNC_ON_SAVE"]:
+                os.fsync(fd)
+            # Taken from our own descriptor: the rename keeps inode and mtime,
+            # and a concurrent save can't slip its file in between.
+            signature = stat_signature(os.fstat(fd))
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, real_path)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+    return signature
+
+
+# The page takes no template variables (note content is fetched separately), so
+# it is rendered once and the bytes are reused with a strong ETag and a short
+# max-age. With template auto-reload on (debug) it is rendered every time.
+_index_html = None
+_index_etag = None
+
+
 @app.route("/")
 def index():
-    return render_template("index.html")
+    global _index_html, _index_etag
+    if _index_html is None or app.jinja_env.auto_reload:
+        _index_html = render_template("index.html").encode("utf-8")
+        _index_etag = hashlib.sha256(_index_html).hexdigest()
+
+    response = Response(_index_html, mimetype="text/html")
+    response.set_etag(_index_etag)
+    if not app.jinja_env.auto_reload:
+        response.cache_control.public = True
+        response.cache_control.max_age = 300
+    return response.make_conditional(request)
 
 
-@app.route("/read-file", methods=["POST"])
+@app.route("/read-file", methods=["GET"])
 def read_file():
-    data = request.get_json()
-    path = data.get("path")
+    path = request.args.get("path")
 
     if not path:
         return jsonify({"error": "No path provided"}), 400
@@ -32,19 +439,23 @@ def read_file():
 
     print(f"Reading file: {abs_path}")
 
-    # Create parent directories if they don't exist
-    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
-
-    # Create file if it doesn't exist
-    if not os.path.exists(abs_path):
-        with open(abs_path, "w", encoding="utf-8") as f:
-            f.write("")
-        print(f"Created new file: {abs_path}")
-
+    # Reading never creates anything: a missing note is a 404 and the first
+    # save creates it (and its directories).
     try:
-        with open(abs_path, "r", encoding="utf-8") as f:
-            content = f.read()
-        return jsonify({"content": content})
+        # A reload of a note we saved last answers 304 without opening it.
+        digest = known_digest(abs_path)
+        etag = digest.hex() if digest is not None else None
+        if etag is not None and request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        # Otherwise it's streamed straight from disk (sendfile where the
+        # server supports it), with ETag/Last-Modified so unchanged reloads
+        # still get a 304.
+        return send_file(
+            abs_path, mimetype="text/plain", conditional=True, etag=etag or True
+        )
     except FileNotFoundError:
         return jsonify({"error": "File not found"}), 404
     except Exception as e:
@@ -54,9 +465,20 @@ def read_file():
 @app.route("/file-updated", methods=["POST"])
 def update_file():
     try:
-        data = request.get_json()
-        path = data.get("path")
-        content = data.get("content")
+        # A text/plain POST is a "simple" request that any web page could send
+        # cross-site without a CORS preflight. Requiring a custom header forces
+        # one (which is never approved), and a foreign Origin is refused too.
+        origin = request.headers.get("Origin")
+        if (
+            "X-Requested-With" not in request.headers
+            or (origin is not None and origin != request.host_url.rstrip("/"))
+        ):
+            return jsonify({"error": "Cross-origin request refused"}), 403
+
+        # The note is posted as the raw UTF-8 request body and written out
+        # as-is, without a JSON decode and re-encode in between.
+        path = request.args.get("path")
+        content = request.get_data()
 
         if not path:
             return jsonify({"error": "No path provided"}), 400
@@ -64,29 +486,24 @@ def update_file():
         path = path.strip().removeprefix('"').removesuffix('"')
         abs_path = os.path.abspath(path)
         dirname = os.path.dirname(abs_path)
-        filename = os.path.basename(abs_path)
+
+        digest = content_digest(content)
+        if known_digest(abs_path) == digest:
+            print("No changes to save")
+            return jsonify({"message": "No changes"}), 200
 
         # Ensure directory exists
         os.makedirs(dirname, exist_ok=True)
 
         # Write content to file
-        with open(abs_path, "w", encoding="utf-8") as f:
-            f.write(content)
+        signature = write_file(abs_path, content)
+        _digests[abs_path] = (digest, signature)
         print("Written to file")
 
-        # Git operations
-        repo = get_or_init_repo(dirname)
-        print("Git repository ready")
-
-        repo.index.add([filename])
-        print(f"Added {filename} to staging")
-
-        repo.index.commit(
-            f"Update {filename} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-        )
-        print("Commit created")
+        schedule_commit(abs_path)
+        print("Commit scheduled")
 
-        return jsonify({"message": "Success"}), 200
+        return jsonify({"message": "Success", "status": "queued", "pending": True}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 